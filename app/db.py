@@ -1,16 +1,46 @@
-from contextlib import contextmanager
-import psycopg
-from psycopg.rows import dict_row
-from .settings import DATABASE_URL
+from typing import Optional
+import asyncpg
+from .settings import DATABASE_URL, READ_ONLY_DATABASE_URL, DB_PREPARED_STATEMENTS
 
-@contextmanager
-def get_conn():
-    conn = psycopg.connect(DATABASE_URL, row_factory=dict_row)
-    try:
-        yield conn
-        conn.commit()
-    except Exception:
-        conn.rollback()
-        raise
-    finally:
-        conn.close()
+_pool: Optional[asyncpg.Pool] = None
+_read_pool: Optional[asyncpg.Pool] = None
+
+
+async def _create_pool(dsn: str) -> asyncpg.Pool:
+    return await asyncpg.create_pool(
+        dsn,
+        min_size=5,
+        max_size=20,
+        statement_cache_size=256 if DB_PREPARED_STATEMENTS else 0,
+    )
+
+async def get_pool() -> asyncpg.Pool:
+    """
+    Process-wide asyncpg pool. Created on first call; the app lifespan
+    opens it at startup and hands it to handlers via app.state.pool.
+    """
+    global _pool
+    if _pool is None:
+        _pool = await _create_pool(DATABASE_URL)
+    return _pool
+
+async def get_read_pool() -> asyncpg.Pool:
+    """
+    Pool for autocommit reads that may tolerate replica lag. Falls back to
+    the primary pool when READ_ONLY_DATABASE_URL is not configured.
+    """
+    global _read_pool
+    if READ_ONLY_DATABASE_URL == DATABASE_URL:
+        return await get_pool()
+    if _read_pool is None:
+        _read_pool = await _create_pool(READ_ONLY_DATABASE_URL)
+    return _read_pool
+
+async def close_pool():
+    global _pool, _read_pool
+    if _read_pool is not None:
+        await _read_pool.close()
+        _read_pool = None
+    if _pool is not None:
+        await _pool.close()
+        _pool = None
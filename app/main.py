@@ -1,122 +1,244 @@
-from fastapi import FastAPI, Header, HTTPException
-from fastapi.responses import JSONResponse, FileResponse
+from contextlib import asynccontextmanager
+
+from fastapi import FastAPI, Header, HTTPException, Request, Response
+from fastapi.responses import ORJSONResponse, FileResponse
 from fastapi.staticfiles import StaticFiles
 
+from collections import OrderedDict
 import hashlib
-import json
-import uuid
-import random
 import asyncio
+import json
+import orjson
 import httpx
 
-from .db import get_conn
+from .db import get_pool, get_read_pool, close_pool
 from .models import CheckoutRequest, CheckoutResponse, WebhookEvent
-from .settings import PROVIDER_TIMEOUT_SECONDS, OUTAGE_PENDING_CAP_CENTS
-
-app = FastAPI(title="Payments Milestone", version="0.1.0")
+from .settings import (
+    PROVIDER_BASE_URL,
+    PROVIDER_TIMEOUT_SECONDS,
+    PROVIDER_MAX_CONCURRENCY,
+    OUTAGE_PENDING_CAP_CENTS,
+    IDEMPOTENCY_RESERVATION_TTL_SECONDS,
+    DB_ACQUIRE_TIMEOUT_SECONDS,
+)
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    app.state.pool = await get_pool()
+    app.state.read_pool = await get_read_pool()
+    app.state.http = httpx.AsyncClient(
+        base_url=PROVIDER_BASE_URL,
+        timeout=PROVIDER_TIMEOUT_SECONDS,
+        limits=httpx.Limits(max_keepalive_connections=100, max_connections=200),
+    )
+    try:
+        yield
+    finally:
+        await app.state.http.aclose()
+        await close_pool()
+
+app = FastAPI(
+    title="Payments Milestone",
+    version="0.1.0",
+    lifespan=lifespan,
+    default_response_class=ORJSONResponse,
+)
 
 # Serve UI static assets under /ui and the main page at /
 app.mount("/ui", StaticFiles(directory="ui"), name="ui")
 
 @app.get("/")
-def root():
+async def root():
     return FileResponse("ui/index.html")
 
 @app.get("/health")
-def health():
+async def health():
     return {"ok": True}
 
-def sha256_json(obj: dict) -> str:
-    raw = json.dumps(obj, sort_keys=True, separators=(",", ":")).encode("utf-8")
+def hash_request(obj: dict) -> str:
+    raw = orjson.dumps(obj, option=orjson.OPT_SORT_KEYS)
+    if not raw.isascii():
+        # orjson writes raw UTF-8 where the original json.dumps escaped to \uXXXX;
+        # keep those bytes so stored request_hash values stay valid
+        raw = json.dumps(obj, sort_keys=True, separators=(",", ":")).encode("utf-8")
     return hashlib.sha256(raw).hexdigest()
 
 
-async def call_provider_simulator(payload: dict) -> dict:
-    async with httpx.AsyncClient() as client:
-        r = await client.post(
-            "http://api:8000/_provider/charge",
-            json=payload,
-            timeout=PROVIDER_TIMEOUT_SECONDS,
-        )
-        r.raise_for_status()
-        return r.json()
+# Caps in-flight provider calls at its healthy capacity so a slow provider
+# cannot make every pending checkout pile up behind it.
+PROVIDER_SEM = asyncio.Semaphore(PROVIDER_MAX_CONCURRENCY)
 
+async def call_provider_simulator(payload: dict) -> dict:
+    # The deadline also covers waiting for a slot: a backlog counts as an outage
+    async with asyncio.timeout(PROVIDER_TIMEOUT_SECONDS):
+        async with PROVIDER_SEM:
+            r = await app.state.http.post("/_provider/charge", json=payload)
+    r.raise_for_status()
+    return r.json()
+
+
+# Writes everything /checkout produces in a single statement:
+#   order -> CHARGE txn + balanced entries (PAID only) -> stored idempotent response.
+# Minimal double-entry ledger for a paid order: DEBIT cash, CREDIT
+# seller_payable, same amount and currency => balanced.
+# The stored response_json must stay identical to the `resp` dict built in checkout().
+# `claim` only matches while this request still owns the reservation it took
+# (same updated_at token, no response yet); once a retry has taken the key over,
+# nothing is written and no id is returned. FOR UPDATE makes a concurrent claim
+# wait and then re-check, so at most one of them writes.
+CREATE_ORDER_SQL = """
+WITH claim AS (
+  SELECT idem_key FROM idempotency_keys
+  WHERE idem_key = $8 AND status_code IS NULL AND updated_at = $9
+  FOR UPDATE
+), new_order AS (
+  INSERT INTO orders(buyer_id, seller_id, amount_cents, currency, buyer_trust, status, ready_to_ship)
+  SELECT $1::text, $2::text, $3::int, $4::text, $5::text, $6::text, $7::boolean FROM claim
+  RETURNING id, amount_cents, currency, status, ready_to_ship
+), new_txn AS (
+  INSERT INTO ledger_transactions(order_id, type, currency, amount_cents)
+  SELECT id, 'CHARGE', currency, amount_cents FROM new_order WHERE status = 'PAID'
+  RETURNING id, currency, amount_cents
+), entries AS (
+  INSERT INTO ledger_entries(txn_id, account, direction, currency, amount_cents)
+  SELECT new_txn.id, v.account, v.direction, new_txn.currency, new_txn.amount_cents
+  FROM new_txn, (VALUES ('cash', 'DEBIT'), ('seller_payable', 'CREDIT')) AS v(account, direction)
+), idem AS (
+  UPDATE idempotency_keys
+  SET status_code = 200,
+      response_json = jsonb_build_object(
+        'order_id', new_order.id::text,
+        'status', new_order.status,
+        'ready_to_ship', new_order.ready_to_ship
+      ),
+      updated_at = NOW()
+  FROM new_order
+  WHERE idem_key = $8
+)
+SELECT id FROM new_order
+"""
+
+# Applies a provider webhook in a single statement:
+#   store event (dedupe key) -> order state change -> ledger (PAID only).
+# Ledger entries as in CREATE_ORDER_SQL: DEBIT cash, CREDIT seller_payable.
+# processed_at is NOW(), i.e. the transaction timestamp, as before.
+APPLY_WEBHOOK_SQL = """
+WITH evt AS (
+  INSERT INTO webhook_events(event_id, order_id, payload, processed_at)
+  VALUES ($1, $2, $3, NOW())
+), upd AS (
+  UPDATE orders
+  SET status = $4, ready_to_ship = ($4 = 'PAID'), updated_at = NOW()
+  WHERE id = $2
+  RETURNING id, currency, amount_cents, status
+), new_txn AS (
+  INSERT INTO ledger_transactions(order_id, type, currency, amount_cents)
+  SELECT id, 'CHARGE', currency, amount_cents FROM upd WHERE status = 'PAID'
+  RETURNING id, currency, amount_cents
+)
+INSERT INTO ledger_entries(txn_id, account, direction, currency, amount_cents)
+SELECT new_txn.id, v.account, v.direction, new_txn.currency, new_txn.amount_cents
+FROM new_txn, (VALUES ('cash', 'DEBIT'), ('seller_payable', 'CREDIT')) AS v(account, direction)
+"""
+
+
+async def lookup_idempotency_key(conn, idempotency_key: str):
+    return await conn.fetchrow(
+        "SELECT request_hash, status_code, response_json "
+        "FROM idempotency_keys WHERE idem_key = $1",
+        idempotency_key,
+    )
 
 
-def create_ledger_for_paid_order(conn, order_id: str):
+async def reserve_idempotency_key(conn, idempotency_key: str, request_hash: str):
     """
-    Minimal double-entry ledger for a paid order:
-      DEBIT  cash
-      CREDIT seller_payable
-    Same amount, same currency => balanced.
+    Insert the key, or take over a same-body reservation older than the TTL.
+    Returns the reservation's updated_at, which the order write checks to make
+    sure it still owns the key; None if someone else holds it.
     """
-    order = conn.execute(
-        "SELECT id, amount_cents, currency, status FROM orders WHERE id = %s",
-        (order_id,),
-    ).fetchone()
-    if not order or order["status"] != "PAID":
-        return
-
-    txn = conn.execute(
-        "INSERT INTO ledger_transactions(order_id, type, currency, amount_cents) "
-        "VALUES (%s, 'CHARGE', %s, %s) RETURNING id",
-        (order_id, order["currency"], order["amount_cents"]),
-    ).fetchone()
-    txn_id = txn["id"]
-
-    amt = order["amount_cents"]
-    cur = order["currency"]
-
-    conn.execute(
-        "INSERT INTO ledger_entries(txn_id, account, direction, currency, amount_cents) "
-        "VALUES (%s, 'cash', 'DEBIT', %s, %s)",
-        (txn_id, cur, amt),
-    )
-    conn.execute(
-        "INSERT INTO ledger_entries(txn_id, account, direction, currency, amount_cents) "
-        "VALUES (%s, 'seller_payable', 'CREDIT', %s, %s)",
-        (txn_id, cur, amt),
+    return await conn.fetchval(
+        "INSERT INTO idempotency_keys(idem_key, request_hash) VALUES ($1, $2) "
+        "ON CONFLICT (idem_key) DO UPDATE SET updated_at = NOW() "
+        "WHERE idempotency_keys.status_code IS NULL "
+        "AND idempotency_keys.request_hash = EXCLUDED.request_hash "
+        "AND idempotency_keys.updated_at < NOW() - make_interval(secs => $3) "
+        "RETURNING updated_at",
+        idempotency_key, request_hash, IDEMPOTENCY_RESERVATION_TTL_SECONDS,
     )
 
 
+async def release_idempotency_key(pool, idempotency_key: str, reserved_at):
+    # Only our own, unfinished reservation: never one a retry has taken over
+    async with pool.acquire(timeout=DB_ACQUIRE_TIMEOUT_SECONDS) as conn:
+        await conn.execute(
+            "DELETE FROM idempotency_keys "
+            "WHERE idem_key = $1 AND status_code IS NULL AND updated_at = $2",
+            idempotency_key, reserved_at,
+        )
+
+
+def replay_or_conflict(existing, request_hash: str):
+    """
+    409 on a body mismatch; the stored response if the key already
+    completed; None if the original request is still in flight.
+    """
+    if existing["request_hash"] != request_hash:
+        raise HTTPException(status_code=409, detail="Idempotency-Key reuse with different request body")
+    if existing["status_code"] and existing["response_json"] is not None:
+        # asyncpg hands jsonb back as text: replay it verbatim
+        return Response(content=existing["response_json"], status_code=existing["status_code"], media_type="application/json")
+    return None
+
+
 @app.post("/checkout", response_model=CheckoutResponse)
-async def checkout(req: CheckoutRequest, idempotency_key: str = Header(None, alias="Idempotency-Key")):
+async def checkout(req: CheckoutRequest, request: Request, idempotency_key: str = Header(None, alias="Idempotency-Key")):
     if not idempotency_key:
         raise HTTPException(status_code=400, detail="Missing Idempotency-Key header")
 
-    request_hash = sha256_json(req.model_dump())
-
-    with get_conn() as conn:
-        # 1) Idempotency lookup
-        existing = conn.execute(
-            "SELECT idem_key, request_hash, status_code, response_json "
-            "FROM idempotency_keys WHERE idem_key = %s",
-            (idempotency_key,),
-        ).fetchone()
-
+    payload = req.model_dump()
+    request_hash = hash_request(payload)
+
+    # 1) Replay fast path, only when a separate (replica) read pool exists.
+    #    On the primary the reserve below is a single autocommit statement that
+    #    already reads the stored row on conflict, so a pre-read would only add
+    #    a round trip to every new key.
+    pool = request.app.state.pool
+    read_pool = request.app.state.read_pool
+    if read_pool is not pool:
+        async with read_pool.acquire(timeout=DB_ACQUIRE_TIMEOUT_SECONDS) as conn:
+            existing = await lookup_idempotency_key(conn, idempotency_key)
         if existing:
-            if existing["request_hash"] != request_hash:
-                raise HTTPException(status_code=409, detail="Idempotency-Key reuse with different request body")
-            if existing["status_code"] and existing["response_json"] is not None:
-                return JSONResponse(status_code=existing["status_code"], content=existing["response_json"])
-
-        # 2) Reserve idempotency key (insert if new)
-        if not existing:
-            conn.execute(
-                "INSERT INTO idempotency_keys(idem_key, request_hash) VALUES (%s, %s)",
-                (idempotency_key, request_hash),
-            )
+            replay = replay_or_conflict(existing, request_hash)
+            if replay is not None:
+                return replay
+
+    # 2) Reserve the key with an autocommit statement: no DB connection or
+    #    transaction stays pinned while we wait on the provider
+    async with pool.acquire(timeout=DB_ACQUIRE_TIMEOUT_SECONDS) as conn:
+        for _ in range(2):
+            reserved_at = await reserve_idempotency_key(conn, idempotency_key, request_hash)
+            if reserved_at is not None:
+                break
+            existing = await lookup_idempotency_key(conn, idempotency_key)
+            if existing:
+                replay = replay_or_conflict(existing, request_hash)
+                if replay is not None:
+                    return replay
+                raise HTTPException(status_code=409, detail="A request with this Idempotency-Key is still in progress")
+            # The holder released the key between our INSERT and SELECT: retry
+        else:
+            raise HTTPException(status_code=409, detail="A request with this Idempotency-Key is still in progress")
 
+    try:
         # 3) Try provider charge
-        provider_payload = req.model_dump()
         provider_down = False
         provider_declined = False
 
         try:
-            provider_resp = await call_provider_simulator(provider_payload)
+            provider_resp = await call_provider_simulator(payload)
             if provider_resp.get("provider_status") == "DECLINED":
                 provider_declined = True
-        except (httpx.TimeoutException, httpx.TransportError):
+        except (httpx.TimeoutException, httpx.TransportError, TimeoutError):
             provider_down = True
 
         # 4) Decide outcome (simple policy)
@@ -135,104 +257,81 @@ async def checkout(req: CheckoutRequest, idempotency_key: str = Header(None, ali
             status = "PAID"
             ready_to_ship = True
 
-        # 5) Create order
-        order = conn.execute(
-            "INSERT INTO orders(buyer_id, seller_id, amount_cents, currency, buyer_trust, status, ready_to_ship) "
-            "VALUES (%s, %s, %s, %s, %s, %s, %s) RETURNING id, status, ready_to_ship",
-            (req.buyer_id, req.seller_id, req.amount_cents, req.currency.upper(), req.buyer_trust, status, ready_to_ship),
-        ).fetchone()
-
-        # If paid immediately, write ledger
-        if status == "PAID":
-            create_ledger_for_paid_order(conn, str(order["id"]))
-
-        resp = {
-            "order_id": str(order["id"]),
-            "status": order["status"],
-            "ready_to_ship": order["ready_to_ship"],
-        }
-
-        # 6) Store idempotent response
-        conn.execute(
-            "UPDATE idempotency_keys SET status_code = %s, response_json = %s, updated_at = NOW() "
-            "WHERE idem_key = %s",
-            (200, json.dumps(resp), idempotency_key),
-        )
-
-        return resp
+        # 5) Create order, ledger (if paid) and idempotent response in one round trip
+        # One statement, so atomic on its own: no BEGIN/COMMIT round trips
+        async with pool.acquire(timeout=DB_ACQUIRE_TIMEOUT_SECONDS) as conn:
+            order_id = await conn.fetchval(
+                CREATE_ORDER_SQL,
+                req.buyer_id, req.seller_id, req.amount_cents, req.currency, req.buyer_trust, status, ready_to_ship,
+                idempotency_key, reserved_at,
+            )
+        if order_id is None:
+            raise HTTPException(status_code=409, detail="Idempotency-Key reservation expired and was taken over by a retry")
+    except BaseException:
+        # Free the reservation so the client can retry with the same key
+        await release_idempotency_key(pool, idempotency_key, reserved_at)
+        raise
+
+    resp = {
+        "order_id": str(order_id),
+        "status": status,
+        "ready_to_ship": ready_to_ship,
+    }
+
+    return resp
     
 @app.get("/orders/{order_id}")
-def get_order(order_id: str):
-    with get_conn() as conn:
-        row = conn.execute(
+async def get_order(order_id: str, request: Request):
+    async with request.app.state.pool.acquire(timeout=DB_ACQUIRE_TIMEOUT_SECONDS) as conn:
+        row = await conn.fetchrow(
             "SELECT id, buyer_id, seller_id, amount_cents, currency, buyer_trust, status, ready_to_ship, created_at, updated_at "
-            "FROM orders WHERE id = %s",
-            (order_id,),
-        ).fetchone()
+            "FROM orders WHERE id = $1",
+            order_id,
+        )
 
         if not row:
             raise HTTPException(status_code=404, detail="Order not found")
 
+        row = dict(row)
         row["id"] = str(row["id"])
         return row
 
 
+# Per-worker LRU of event_ids already committed, so at-least-once
+# redeliveries skip the DB. Hits refresh recency; the least recently seen
+# id is evicted past SEEN_EVENTS_MAX. The primary key on webhook_events
+# stays the authoritative dedupe guard.
+SEEN_EVENTS_MAX = 100_000
+_seen_events: "OrderedDict[str, None]" = OrderedDict()
+
+def remember_event(event_id: str):
+    _seen_events[event_id] = None
+    _seen_events.move_to_end(event_id)
+    while len(_seen_events) > SEEN_EVENTS_MAX:
+        _seen_events.popitem(last=False)
+
+
 @app.post("/webhooks/provider")
-def provider_webhook(evt: WebhookEvent):
+async def provider_webhook(evt: WebhookEvent, request: Request):
     """
     Replay-safe: event_id is unique; duplicates are ignored.
     """
-    with get_conn() as conn:
-        existing = conn.execute(
-            "SELECT event_id FROM webhook_events WHERE event_id = %s",
-            (evt.event_id,),
-        ).fetchone()
-        if existing:
-            return {"ok": True, "duplicate": True}
-
-        # Store event first (dedupe key)
-        conn.execute(
-            "INSERT INTO webhook_events(event_id, order_id, payload) VALUES (%s, %s, %s)",
-            (evt.event_id, evt.order_id, json.dumps(evt.model_dump())),
+    if evt.event_id in _seen_events:
+        _seen_events.move_to_end(evt.event_id)
+        return {"ok": True, "duplicate": True}
+
+    async with request.app.state.pool.acquire(timeout=DB_ACQUIRE_TIMEOUT_SECONDS) as conn, conn.transaction():
+        existing = await conn.fetchrow(
+            "SELECT event_id FROM webhook_events WHERE event_id = $1",
+            evt.event_id,
         )
-
-        # Apply state change
-        if evt.outcome == "PAID":
-            conn.execute(
-                "UPDATE orders SET status = 'PAID', ready_to_ship = TRUE, updated_at = NOW() WHERE id = %s",
-                (evt.order_id,),
-            )
-            create_ledger_for_paid_order(conn, evt.order_id)
-        else:
-            conn.execute(
-                "UPDATE orders SET status = 'FAILED', ready_to_ship = FALSE, updated_at = NOW() WHERE id = %s",
-                (evt.order_id,),
+        if not existing:
+            # Store event and apply the state change in one round trip
+            await conn.execute(
+                APPLY_WEBHOOK_SQL,
+                evt.event_id, evt.order_id, orjson.dumps(evt.model_dump()).decode(), evt.outcome,
             )
 
-        conn.execute(
-            "UPDATE webhook_events SET processed_at = NOW() WHERE event_id = %s",
-            (evt.event_id,),
-        )
-
-        return {"ok": True, "duplicate": False}
-
-
-@app.post("/_provider/charge")
-async def provider_charge_simulator(payload: dict):
-    """
-    Random behavior:
-      - ~35%: slow response => client timeout simulates outage
-      - ~10%: declined
-      - rest: success
-    """
-    roll = random.random()
-
-    if roll < 0.35:
-        await asyncio.sleep(PROVIDER_TIMEOUT_SECONDS * 10)  # intentionally slow
-        # Even though we eventually return, client will timeout
-        return {"provider_status": "SUCCEEDED", "provider_payment_id": str(uuid.uuid4())}
-
-    if roll < 0.45:
-        return {"provider_status": "DECLINED", "provider_payment_id": None}
-
-    return {"provider_status": "SUCCEEDED", "provider_payment_id": str(uuid.uuid4())}
+    # Only after commit: a rolled-back event must still be retried
+    remember_event(evt.event_id)
+    return {"ok": True, "duplicate": bool(existing)}
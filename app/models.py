@@ -1,4 +1,4 @@
-from pydantic import BaseModel, Field
+from pydantic import BaseModel, Field, field_validator
 from typing import Literal, Optional
 
 BuyerTrust = Literal["trusted", "new"]
@@ -10,6 +10,11 @@ class CheckoutRequest(BaseModel):
     currency: str = Field(min_length=3, max_length=3)
     buyer_trust: BuyerTrust
 
+    @field_validator("currency")
+    @classmethod
+    def _upper_currency(cls, v: str) -> str:
+        return v.upper()
+
 class CheckoutResponse(BaseModel):
     order_id: str
     status: Literal["PENDING_PAYMENT", "PAID", "FAILED"]
@@ -0,0 +1,31 @@
+from fastapi import FastAPI
+
+import uuid
+import random
+import asyncio
+
+from .settings import PROVIDER_TIMEOUT_SECONDS
+
+# Runs as its own process (see docker-compose `provider` service) so the
+# simulated outages never park tasks or sockets in the API workers.
+app = FastAPI(title="Payments Provider Simulator", version="0.1.0")
+
+@app.post("/_provider/charge")
+async def provider_charge_simulator(payload: dict):
+    """
+    Random behavior:
+      - ~35%: slow response => client timeout simulates outage
+      - ~10%: declined
+      - rest: success
+    """
+    roll = random.random()
+
+    if roll < 0.35:
+        await asyncio.sleep(PROVIDER_TIMEOUT_SECONDS * 10)  # intentionally slow
+        # Even though we eventually return, client will timeout
+        return {"provider_status": "SUCCEEDED", "provider_payment_id": uuid.uuid4().hex}
+
+    if roll < 0.45:
+        return {"provider_status": "DECLINED", "provider_payment_id": None}
+
+    return {"provider_status": "SUCCEEDED", "provider_payment_id": uuid.uuid4().hex}
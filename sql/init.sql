@@ -14,12 +14,24 @@ CREATE TABLE IF NOT EXISTS orders (
 );
 
 CREATE TABLE IF NOT EXISTS idempotency_keys (
-  idem_key TEXT PRIMARY KEY,
+  idem_key TEXT NOT NULL,
   request_hash TEXT NOT NULL,
   status_code INT,
   response_json JSONB,
   created_at TIMESTAMPTZ NOT NULL DEFAULT NOW(),
-  updated_at TIMESTAMPTZ NOT NULL DEFAULT NOW()
+  updated_at TIMESTAMPTZ NOT NULL DEFAULT NOW(),
+  -- The primary key covers the replay lookup, so it is answered index-only
+  -- (no heap visit) without maintaining a second unique index. Existing
+  -- databases: sql/migrations/001_idempotency_keys_covering_pkey.sql builds it
+  -- CONCURRENTLY and swaps it in.
+  PRIMARY KEY (idem_key) INCLUDE (request_hash, status_code, response_json)
+);
+
+-- Index-only scans need an up-to-date visibility map; vacuum this
+-- insert/update-heavy table more eagerly than the defaults.
+ALTER TABLE idempotency_keys SET (
+  autovacuum_vacuum_scale_factor = 0.01,
+  autovacuum_vacuum_insert_scale_factor = 0.01
 );
 
 CREATE TABLE IF NOT EXISTS webhook_events (
@@ -0,0 +1,18 @@
+-- Brings an existing idempotency_keys table to the covering primary key that
+-- sql/init.sql creates for new databases, without blocking writes while the
+-- index builds. Run with psql in autocommit mode (no surrounding BEGIN):
+-- CREATE INDEX CONCURRENTLY cannot run inside a transaction block.
+--
+--   psql "$DATABASE_URL" -f sql/migrations/001_idempotency_keys_covering_pkey.sql
+
+CREATE UNIQUE INDEX CONCURRENTLY IF NOT EXISTS idempotency_keys_covering
+  ON idempotency_keys(idem_key) INCLUDE (request_hash, status_code, response_json);
+
+-- Swap the primary key onto the new index. Only a brief ACCESS EXCLUSIVE lock
+-- for the catalog change; the old index is dropped with the old constraint and
+-- the new one is renamed to idempotency_keys_pkey.
+BEGIN;
+ALTER TABLE idempotency_keys
+  DROP CONSTRAINT idempotency_keys_pkey,
+  ADD CONSTRAINT idempotency_keys_pkey PRIMARY KEY USING INDEX idempotency_keys_covering;
+COMMIT;
@@ -0,0 +1,25 @@
+from contextlib import asynccontextmanager
+
+import pytest
+from fastapi.testclient import TestClient
+
+from app.main import app
+
+
+class FakePool:
+    """Hands out the one fake connection; counts how often it was acquired."""
+
+    def __init__(self, conn):
+        self.conn = conn
+        self.acquired = 0
+
+    @asynccontextmanager
+    async def acquire(self, timeout=None):
+        self.acquired += 1
+        yield self.conn
+
+
+@pytest.fixture
+def client():
+    # Not entered as a context manager, so the lifespan (real pools) never runs
+    return TestClient(app)
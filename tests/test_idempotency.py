@@ -0,0 +1,300 @@
+import asyncio
+import hashlib
+import json
+import uuid
+
+import pytest
+
+from app import main
+from app.main import app, call_provider_simulator, hash_request, CREATE_ORDER_SQL
+from app.models import CheckoutRequest
+from app.settings import IDEMPOTENCY_RESERVATION_TTL_SECONDS
+
+from conftest import FakePool
+
+BODY = {"buyer_id": "b1", "seller_id": "s1", "amount_cents": 5000, "currency": "EUR", "buyer_trust": "trusted"}
+HEADERS = {"Idempotency-Key": "key-1"}
+
+
+def body_hash(body=BODY):
+    return hash_request(CheckoutRequest(**body).model_dump())
+
+
+class FakeDB:
+    """
+    In-memory stand-in for the idempotency_keys / orders statements checkout
+    issues, following the SQL's semantics. `clock` plays the role of NOW().
+    """
+
+    def __init__(self):
+        self.clock = 1000.0
+        self.keys = {}
+        self.orders = []
+        self.lookups = 0
+        self.before_lookup = None
+
+    async def fetchrow(self, sql, key):
+        self.lookups += 1
+        if self.before_lookup:
+            self.before_lookup()
+        return self.keys.get(key)
+
+    async def fetchval(self, sql, *args):
+        if sql is CREATE_ORDER_SQL:
+            return self._create_order(*args)
+        return self._reserve(*args)
+
+    async def execute(self, sql, key, reserved_at):
+        row = self.keys.get(key)
+        if row and row["status_code"] is None and row["updated_at"] == reserved_at:
+            del self.keys[key]
+
+    def _reserve(self, key, request_hash, ttl):
+        row = self.keys.get(key)
+        if row is None:
+            self.keys[key] = {"request_hash": request_hash, "status_code": None,
+                              "response_json": None, "updated_at": self.clock}
+            return self.clock
+        if (row["status_code"] is None and row["request_hash"] == request_hash
+                and row["updated_at"] < self.clock - ttl):
+            row["updated_at"] = self.clock
+            return self.clock
+        return None
+
+    def _create_order(self, buyer_id, seller_id, amount_cents, currency, buyer_trust,
+                      status, ready_to_ship, key, reserved_at):
+        row = self.keys.get(key)
+        if not row or row["status_code"] is not None or row["updated_at"] != reserved_at:
+            return None
+        order_id = uuid.uuid4()
+        self.orders.append((order_id, status))
+        row["status_code"] = 200
+        row["response_json"] = (
+            f'{{"order_id": "{order_id}", "status": "{status}", '
+            f'"ready_to_ship": {"true" if ready_to_ship else "false"}}}'
+        )
+        row["updated_at"] = self.clock
+        return order_id
+
+
+class FakeResponse:
+    def __init__(self, data):
+        self.data = data
+
+    def raise_for_status(self):
+        pass
+
+    def json(self):
+        return self.data
+
+
+class FakeProvider:
+    def __init__(self, result=None, on_call=None):
+        self.result = result or {"provider_status": "SUCCEEDED", "provider_payment_id": "p1"}
+        self.on_call = on_call
+        self.calls = 0
+
+    async def post(self, url, json):
+        self.calls += 1
+        if self.on_call:
+            await self.on_call()
+        return FakeResponse(self.result)
+
+
+@pytest.fixture(autouse=True)
+def db():
+    db = FakeDB()
+    app.state.pool = app.state.read_pool = FakePool(db)
+    return db
+
+
+@pytest.fixture(autouse=True)
+def provider():
+    app.state.http = FakeProvider()
+    return app.state.http
+
+
+def test_new_key_creates_order_and_stores_response(client, db):
+    r = client.post("/checkout", json=BODY, headers=HEADERS)
+
+    assert r.status_code == 200
+    assert r.json()["status"] == "PAID"
+    assert db.keys["key-1"]["status_code"] == 200
+    assert len(db.orders) == 1
+
+
+def test_completed_key_replays_stored_response(client, db, provider):
+    first = client.post("/checkout", json=BODY, headers=HEADERS).json()
+
+    r = client.post("/checkout", json=BODY, headers=HEADERS)
+
+    assert r.json() == first
+    assert provider.calls == 1
+    assert len(db.orders) == 1
+
+
+def test_body_mismatch_is_409(client, db):
+    client.post("/checkout", json=BODY, headers=HEADERS)
+
+    r = client.post("/checkout", json={**BODY, "amount_cents": 6000}, headers=HEADERS)
+
+    assert r.status_code == 409
+    assert "different request body" in r.json()["detail"]
+
+
+def test_new_key_on_primary_skips_the_pre_read(client, db):
+    client.post("/checkout", json=BODY, headers=HEADERS)
+
+    assert db.lookups == 0
+
+
+def test_replica_pool_serves_completed_replays(client, db, provider):
+    first = client.post("/checkout", json=BODY, headers=HEADERS).json()
+    app.state.read_pool = FakePool(db)
+    app.state.pool = None  # any use of the primary would fail
+
+    r = client.post("/checkout", json=BODY, headers=HEADERS)
+
+    assert r.json() == first
+    assert provider.calls == 1
+
+
+def test_unfinished_reservation_is_409_in_progress(client, db, provider):
+    db._reserve("key-1", body_hash(), IDEMPOTENCY_RESERVATION_TTL_SECONDS)
+
+    r = client.post("/checkout", json=BODY, headers=HEADERS)
+
+    assert r.status_code == 409
+    assert "in progress" in r.json()["detail"]
+    assert provider.calls == 0
+
+
+def test_key_released_between_insert_and_lookup_is_retried(client, db):
+    db._reserve("key-1", body_hash(), IDEMPOTENCY_RESERVATION_TTL_SECONDS)
+    db.before_lookup = lambda: db.keys.pop("key-1", None)
+
+    r = client.post("/checkout", json=BODY, headers=HEADERS)
+
+    assert r.status_code == 200
+    assert len(db.orders) == 1
+
+
+def test_reservation_released_on_503(client, db, provider):
+    async def provider_times_out():
+        raise TimeoutError
+    provider.on_call = provider_times_out
+
+    r = client.post("/checkout", json={**BODY, "buyer_trust": "new"}, headers=HEADERS)
+
+    assert r.status_code == 503
+    assert "key-1" not in db.keys
+    assert db.orders == []
+
+
+def test_reservation_released_on_unexpected_error(client, db, provider):
+    async def provider_breaks():
+        raise RuntimeError("boom")
+    provider.on_call = provider_breaks
+
+    with pytest.raises(RuntimeError):
+        client.post("/checkout", json=BODY, headers=HEADERS)
+
+    assert "key-1" not in db.keys
+
+
+def test_stale_reservation_is_taken_over(client, db):
+    db._reserve("key-1", body_hash(), IDEMPOTENCY_RESERVATION_TTL_SECONDS)
+    db.clock += IDEMPOTENCY_RESERVATION_TTL_SECONDS + 1
+
+    r = client.post("/checkout", json=BODY, headers=HEADERS)
+
+    assert r.status_code == 200
+    assert len(db.orders) == 1
+
+
+def test_stale_reservation_with_other_body_is_not_taken_over(client, db):
+    db._reserve("key-1", body_hash({**BODY, "amount_cents": 6000}), IDEMPOTENCY_RESERVATION_TTL_SECONDS)
+    db.clock += IDEMPOTENCY_RESERVATION_TTL_SECONDS + 1
+
+    r = client.post("/checkout", json=BODY, headers=HEADERS)
+
+    assert r.status_code == 409
+    assert "different request body" in r.json()["detail"]
+
+
+def test_taken_over_request_does_not_write_an_order(client, db, provider):
+    async def retry_takes_over():
+        # A retry takes the key over while the original waits on the provider
+        db.clock += IDEMPOTENCY_RESERVATION_TTL_SECONDS + 1
+        db._reserve("key-1", body_hash(), IDEMPOTENCY_RESERVATION_TTL_SECONDS)
+    provider.on_call = retry_takes_over
+
+    r = client.post("/checkout", json=BODY, headers=HEADERS)
+
+    assert r.status_code == 409
+    assert db.orders == []
+    # The retry's reservation is left alone for it to complete
+    assert db.keys["key-1"]["updated_at"] == db.clock
+
+
+def test_provider_deadline_counts_as_provider_down(client, db, provider, monkeypatch):
+    monkeypatch.setattr(main, "PROVIDER_TIMEOUT_SECONDS", 0.05)
+
+    async def slow_provider():
+        await asyncio.sleep(1)
+    provider.on_call = slow_provider
+
+    r = client.post("/checkout", json=BODY, headers=HEADERS)
+
+    assert r.status_code == 200
+    assert r.json()["status"] == "PENDING_PAYMENT"
+
+
+def test_provider_calls_are_bounded_by_semaphore(monkeypatch):
+    in_flight = 0
+    peak = 0
+
+    async def track():
+        nonlocal in_flight, peak
+        in_flight += 1
+        peak = max(peak, in_flight)
+        await asyncio.sleep(0.01)
+        in_flight -= 1
+
+    async def run():
+        monkeypatch.setattr(main, "PROVIDER_SEM", asyncio.Semaphore(2))
+        app.state.http = FakeProvider(on_call=track)
+        await asyncio.gather(*(call_provider_simulator({}) for _ in range(6)))
+
+    asyncio.run(run())
+
+    assert peak == 2
+
+
+def test_waiting_for_a_provider_slot_counts_toward_the_deadline(monkeypatch):
+    monkeypatch.setattr(main, "PROVIDER_TIMEOUT_SECONDS", 0.05)
+
+    async def run():
+        sem = asyncio.Semaphore(1)
+        monkeypatch.setattr(main, "PROVIDER_SEM", sem)
+        app.state.http = FakeProvider()
+        async with sem:
+            await call_provider_simulator({})
+
+    with pytest.raises(TimeoutError):
+        asyncio.run(run())
+
+
+@pytest.mark.parametrize("buyer_id", ["b1", "bücher-ø", "买家"])
+def test_request_hash_matches_legacy_json_dumps_digest(buyer_id):
+    payload = CheckoutRequest(**{**BODY, "buyer_id": buyer_id}).model_dump()
+    legacy = json.dumps(payload, sort_keys=True, separators=(",", ":")).encode("utf-8")
+
+    assert hash_request(payload) == hashlib.sha256(legacy).hexdigest()
+
+
+def test_currency_case_does_not_change_the_request_hash():
+    lower = CheckoutRequest(**{**BODY, "currency": "eur"})
+
+    assert lower.currency == "EUR"
+    assert hash_request(lower.model_dump()) == body_hash()
@@ -0,0 +1,153 @@
+"""
+The checkout and webhook SQL against a real Postgres. Skipped unless
+TEST_DATABASE_URL points at a database the tests may create the schema in
+(sql/init.sql).
+"""
+import asyncio
+import os
+import pathlib
+import uuid
+
+import asyncpg
+import pytest
+
+from app import main
+from app.main import (
+    APPLY_WEBHOOK_SQL,
+    CREATE_ORDER_SQL,
+    reserve_idempotency_key,
+    release_idempotency_key,
+)
+
+TEST_DATABASE_URL = os.environ.get("TEST_DATABASE_URL")
+INIT_SQL = pathlib.Path(__file__).parent.parent / "sql" / "init.sql"
+
+pytestmark = pytest.mark.skipif(not TEST_DATABASE_URL, reason="TEST_DATABASE_URL not set")
+
+
+def run_with_pool(test):
+    async def run():
+        pool = await asyncpg.create_pool(TEST_DATABASE_URL, min_size=1, max_size=2)
+        try:
+            async with pool.acquire() as conn:
+                await conn.execute(INIT_SQL.read_text())
+            await test(pool)
+        finally:
+            await pool.close()
+    asyncio.run(run())
+
+
+def order_args(key, reserved_at, status="PAID"):
+    return ("b1", "s1", 5000, "EUR", "trusted", status, status == "PAID", key, reserved_at)
+
+
+def test_reserve_takeover_claim_release(monkeypatch):
+    key = f"pg-{uuid.uuid4()}"
+
+    async def test(pool):
+        async with pool.acquire() as conn:
+            first = await reserve_idempotency_key(conn, key, "h1")
+            assert first is not None
+            # Fresh reservation: neither a second reserve nor a takeover
+            assert await reserve_idempotency_key(conn, key, "h1") is None
+
+            monkeypatch.setattr(main, "IDEMPOTENCY_RESERVATION_TTL_SECONDS", 0)
+            assert await reserve_idempotency_key(conn, key, "other-body") is None
+            second = await reserve_idempotency_key(conn, key, "h1")
+            assert second is not None and second > first
+
+            # The original request lost the key: nothing is written
+            assert await conn.fetchval(CREATE_ORDER_SQL, *order_args(key, first)) is None
+            await release_idempotency_key(pool, key, first)
+            row = await conn.fetchrow(
+                "SELECT status_code, updated_at FROM idempotency_keys WHERE idem_key = $1", key)
+            assert row["status_code"] is None and row["updated_at"] == second
+
+            order_id = await conn.fetchval(CREATE_ORDER_SQL, *order_args(key, second))
+            assert order_id is not None
+            row = await conn.fetchrow(
+                "SELECT status_code, response_json::jsonb AS resp FROM idempotency_keys WHERE idem_key = $1", key)
+            assert row["status_code"] == 200
+            assert await conn.fetchval(
+                "SELECT $1::jsonb = jsonb_build_object('order_id', $2::text, 'status', 'PAID', 'ready_to_ship', true)",
+                row["resp"], str(order_id))
+            entries = await conn.fetch(
+                "SELECT e.direction, e.amount_cents, e.currency FROM ledger_entries e "
+                "JOIN ledger_transactions t ON t.id = e.txn_id WHERE t.order_id = $1 ORDER BY e.direction",
+                order_id)
+            assert [tuple(e) for e in entries] == [("CREDIT", 5000, "EUR"), ("DEBIT", 5000, "EUR")]
+
+            # Completed keys are never released or claimed again
+            await release_idempotency_key(pool, key, second)
+            assert await conn.fetchval(CREATE_ORDER_SQL, *order_args(key, second)) is None
+            assert await conn.fetchval("SELECT count(*) FROM orders WHERE id = $1", order_id) == 1
+            assert await conn.fetchval(
+                "SELECT status_code FROM idempotency_keys WHERE idem_key = $1", key) == 200
+
+    run_with_pool(test)
+
+
+def test_release_deletes_own_unfinished_reservation():
+    key = f"pg-{uuid.uuid4()}"
+
+    async def test(pool):
+        async with pool.acquire() as conn:
+            reserved_at = await reserve_idempotency_key(conn, key, "h1")
+            await release_idempotency_key(pool, key, reserved_at)
+            assert await conn.fetchval(
+                "SELECT count(*) FROM idempotency_keys WHERE idem_key = $1", key) == 0
+            # Released keys can be reserved again straight away
+            assert await reserve_idempotency_key(conn, key, "h1") is not None
+
+    run_with_pool(test)
+
+
+def test_pending_order_writes_no_ledger():
+    key = f"pg-{uuid.uuid4()}"
+
+    async def test(pool):
+        async with pool.acquire() as conn:
+            reserved_at = await reserve_idempotency_key(conn, key, "h1")
+            order_id = await conn.fetchval(CREATE_ORDER_SQL, *order_args(key, reserved_at, "PENDING_PAYMENT"))
+            assert await conn.fetchval(
+                "SELECT status FROM orders WHERE id = $1", order_id) == "PENDING_PAYMENT"
+            assert await conn.fetchval(
+                "SELECT count(*) FROM ledger_transactions WHERE order_id = $1", order_id) == 0
+
+    run_with_pool(test)
+
+
+async def pending_order(conn):
+    key = f"pg-{uuid.uuid4()}"
+    reserved_at = await reserve_idempotency_key(conn, key, "h1")
+    return await conn.fetchval(CREATE_ORDER_SQL, *order_args(key, reserved_at, "PENDING_PAYMENT"))
+
+
+@pytest.mark.parametrize("outcome, ledger_entries", [("PAID", 2), ("FAILED", 0)])
+def test_apply_webhook(outcome, ledger_entries):
+    event_id = f"evt-{uuid.uuid4()}"
+
+    async def test(pool):
+        async with pool.acquire() as conn:
+            order_id = await pending_order(conn)
+            await conn.execute(APPLY_WEBHOOK_SQL, event_id, str(order_id), '{"outcome": "x"}', outcome)
+
+            order = await conn.fetchrow("SELECT status, ready_to_ship FROM orders WHERE id = $1", order_id)
+            assert (order["status"], order["ready_to_ship"]) == (outcome, outcome == "PAID")
+            evt = await conn.fetchrow(
+                "SELECT order_id, payload::jsonb->>'outcome' AS outcome, processed_at "
+                "FROM webhook_events WHERE event_id = $1", event_id)
+            assert evt["order_id"] == order_id and evt["outcome"] == "x"
+            assert evt["processed_at"] is not None
+            balance = await conn.fetchrow(
+                "SELECT count(*) AS n, "
+                "coalesce(sum(CASE e.direction WHEN 'DEBIT' THEN e.amount_cents ELSE -e.amount_cents END), 0) AS net "
+                "FROM ledger_entries e JOIN ledger_transactions t ON t.id = e.txn_id WHERE t.order_id = $1",
+                order_id)
+            assert (balance["n"], balance["net"]) == (ledger_entries, 0)
+
+            # The event_id primary key is what rejects a redelivery
+            with pytest.raises(asyncpg.UniqueViolationError):
+                await conn.execute(APPLY_WEBHOOK_SQL, event_id, str(order_id), "{}", outcome)
+
+    run_with_pool(test)
@@ -0,0 +1,103 @@
+import json
+from contextlib import asynccontextmanager
+
+import pytest
+
+from app import main
+from app.main import app, remember_event, APPLY_WEBHOOK_SQL, SEEN_EVENTS_MAX
+
+from conftest import FakePool
+
+
+class FakeConn:
+    def __init__(self, existing=None, fail=False):
+        self.existing = existing
+        self.fail = fail
+        self.applied = []
+
+    @asynccontextmanager
+    async def transaction(self):
+        yield
+
+    async def fetchrow(self, sql, *args):
+        return self.existing
+
+    async def execute(self, sql, *args):
+        if self.fail:
+            raise RuntimeError("db down")
+        self.applied.append((sql, args))
+
+
+@pytest.fixture(autouse=True)
+def clear_seen_events():
+    main._seen_events.clear()
+    yield
+    main._seen_events.clear()
+
+
+def event(event_id="evt-1"):
+    return {"event_id": event_id, "order_id": "00000000-0000-0000-0000-000000000001", "outcome": "PAID"}
+
+
+def test_new_event_is_applied_and_remembered(client):
+    pool = FakePool(FakeConn())
+    app.state.pool = pool
+
+    r = client.post("/webhooks/provider", json=event())
+
+    assert r.json() == {"ok": True, "duplicate": False}
+    [(sql, (event_id, order_id, payload, outcome))] = pool.conn.applied
+    assert sql is APPLY_WEBHOOK_SQL
+    assert (event_id, order_id, outcome) == ("evt-1", event()["order_id"], "PAID")
+    assert json.loads(payload) == event()
+    assert "evt-1" in main._seen_events
+
+
+def test_duplicate_found_in_db_is_not_reapplied(client):
+    pool = FakePool(FakeConn(existing={"event_id": "evt-1"}))
+    app.state.pool = pool
+
+    r = client.post("/webhooks/provider", json=event())
+
+    assert r.json() == {"ok": True, "duplicate": True}
+    assert pool.conn.applied == []
+    assert "evt-1" in main._seen_events
+
+
+def test_cache_hit_skips_the_db(client):
+    pool = FakePool(FakeConn())
+    app.state.pool = pool
+    remember_event("evt-1")
+
+    r = client.post("/webhooks/provider", json=event())
+
+    assert r.json() == {"ok": True, "duplicate": True}
+    assert pool.acquired == 0
+
+
+def test_cache_hit_refreshes_recency(client):
+    app.state.pool = FakePool(FakeConn())
+    remember_event("evt-1")
+    remember_event("evt-2")
+
+    client.post("/webhooks/provider", json=event("evt-1"))
+
+    assert list(main._seen_events) == ["evt-2", "evt-1"]
+
+
+def test_cache_is_bounded_and_evicts_least_recently_seen():
+    for i in range(SEEN_EVENTS_MAX + 1):
+        remember_event(f"evt-{i}")
+
+    assert len(main._seen_events) == SEEN_EVENTS_MAX
+    assert "evt-0" not in main._seen_events
+    assert f"evt-{SEEN_EVENTS_MAX}" in main._seen_events
+
+
+def test_event_not_remembered_when_transaction_raises(client):
+    app.state.pool = FakePool(FakeConn(fail=True))
+
+    with pytest.raises(RuntimeError):
+        client.post("/webhooks/provider", json=event())
+
+    assert "evt-1" not in main._seen_events